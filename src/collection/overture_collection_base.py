@@ -46,7 +46,10 @@ class OvertureBaseCollection:
             "user": settings.POSTGRES_USER,
             "password": settings.POSTGRES_PASSWORD,
             "driver": "org.postgresql.Driver",
-            "batchsize": "10000"
+            "batchsize": "10000",
+            "numPartitions": "8",
+            "reWriteBatchedInserts": "true",
+            "stringtype": "unspecified"
         }
 
     @timing
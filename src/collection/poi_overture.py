@@ -1,5 +1,3 @@
-import time
-
 from pyspark.sql.functions import col, expr, to_json
 from pyspark.sql.types import TimestampType
 from sedona.spark import SedonaContext
@@ -32,19 +30,19 @@ class OverturePOICollection(OvertureBaseCollection):
             DROP TABLE IF EXISTS temporal.places_{self.region}_raw_no_geom;
             CREATE TABLE temporal.places_{self.region}_raw_no_geom (
                 id TEXT PRIMARY KEY,
-                categories TEXT,
+                categories JSONB,
                 updatetime TIMESTAMPTZ,
                 version INT,
-                names TEXT,
+                names JSONB,
                 confidence DOUBLE PRECISION,
                 websites TEXT,
                 socials TEXT,
                 emails TEXT,
                 phones TEXT,
-                brand TEXT,
-                addresses TEXT,
-                sources TEXT,
-                geometry TEXT
+                brand JSONB,
+                addresses JSONB,
+                sources JSONB,
+                geometry BYTEA
             );
         """
         self.db_local.perform(sql_create_table_places)
@@ -53,54 +51,34 @@ class OverturePOICollection(OvertureBaseCollection):
     def filter_region_places(self, bbox_coords: dict):
         """Initialize the places dataframe and apply relevant filters."""
 
-        # Select the necessary columns
-        places = self.places_df.selectExpr(
-            "id",
-            "updatetime",
-            "version",
-            "names",
-            "categories",
-            "confidence",
-            "websites",
-            "socials",
-            "emails",
-            "phones",
-            "brand",
-            "addresses",
-            "sources",
-            "ST_AsText(geometry) AS geometry",
-            "bbox"
+        # Filter on the native bbox struct columns first so Parquet row group statistics can prune the scan
+        places = self.places_df.filter(
+            (col("bbox.minx") > bbox_coords["xmin"]) &
+            (col("bbox.miny") > bbox_coords["ymin"]) &
+            (col("bbox.maxx") < bbox_coords["xmax"]) &
+            (col("bbox.maxy") < bbox_coords["ymax"])
         )
 
-        places = self.places_df.filter(
-            (places.bbox.minx > bbox_coords["xmin"]) &
-            (places.bbox.miny > bbox_coords["ymin"]) &
-            (places.bbox.maxx < bbox_coords["xmax"]) &
-            (places.bbox.maxy < bbox_coords["ymax"])
+        # Sort by bbox within each partition so spatially close places are written together
+        places = places.sortWithinPartitions(col("bbox.minx"), col("bbox.miny"))
+
+        # Select the necessary columns and convert the complex types to JSON strings in a single projection
+        places = places.select(
+            col("id"),
+            col("updatetime").cast(TimestampType()).alias("updatetime"),
+            col("version"),
+            to_json(col("names")).alias("names"),
+            to_json(col("categories")).alias("categories"),
+            col("confidence"),
+            to_json(col("websites")).alias("websites"),
+            to_json(col("socials")).alias("socials"),
+            to_json(col("emails")).alias("emails"),
+            to_json(col("phones")).alias("phones"),
+            to_json(col("brand")).alias("brand"),
+            to_json(col("addresses")).alias("addresses"),
+            to_json(col("sources")).alias("sources"),
+            expr("ST_AsEWKB(geometry)").alias("geometry")
         )
-        places = places.drop(places.bbox)
-
-        # Convert the complex types to JSON strings
-        complex_columns = [
-            "updatetime",
-            "names",
-            "categories",
-            "brand",
-            "addresses",
-            "sources",
-            "websites",
-            "socials",
-            "emails",
-            "phones",
-        ]
-
-        for column in complex_columns:
-            if column == "updatetime":
-                places = places.withColumn(column, col(column).cast(TimestampType()))
-            else:
-                places = places.withColumn(column, to_json(column))
-
-        places = places.withColumn("geometry", expr("ST_AsText(geometry)"))
 
         return places
 
@@ -110,16 +88,20 @@ class OverturePOICollection(OvertureBaseCollection):
 
         print_info(f"Starting to alter tables temporal.places_{self.region}_raw and temporal.places_{self.region}.")
 
-        # get the geometires of the study area based on the query defined in the config
-        region_geoms = self.db_local.select(self.data_config_collection['region'])
+        # get the geometires of the study area as WKT based on the query defined in the config
+        region_geoms = self.db_local.select(
+            f"""SELECT ST_AsText(geom) FROM ({self.data_config_collection['region']}) AS region"""
+        )
 
         # create index on places raw
         create_table_with_geom_sql = f"""
             DROP TABLE IF EXISTS temporal.places_{self.region}_raw;
             CREATE UNLOGGED TABLE temporal.places_{self.region}_raw AS
-            SELECT id, categories, updatetime, version, names, confidence, websites, socials, emails, phones, brand, addresses, sources, ST_SetSRID(ST_GeomFromText(geometry), 4326) AS geometry
+            SELECT id, categories, updatetime, version, names, confidence, websites, socials, emails, phones, brand, addresses, sources, ST_SetSRID(ST_GeomFromEWKB(geometry), 4326) AS geometry
             FROM temporal.places_{self.region}_raw_no_geom;
-            CREATE INDEX ON temporal.places_{self.region}_raw USING GIST (geometry);
+            CREATE INDEX ON temporal.places_{self.region}_raw USING SPGIST (geometry);
+            CREATE INDEX ON temporal.places_{self.region}_raw USING GIN (categories jsonb_path_ops);
+            ANALYZE temporal.places_{self.region}_raw;
         """
         self.db_local.perform(create_table_with_geom_sql)
         print_info(f"Created new unlogged table temporal.places_{self.region}_raw with converted geometry")
@@ -133,6 +115,9 @@ class OverturePOICollection(OvertureBaseCollection):
                 WHERE 1=0
             );
             ALTER TABLE temporal.places_{self.region}
+            ALTER COLUMN names TYPE text USING names::text,
+            ALTER COLUMN categories TYPE text USING categories::text,
+            ALTER COLUMN brand TYPE text USING brand::text,
             ADD COLUMN IF NOT EXISTS other_categories varchar[],
             ADD COLUMN IF NOT EXISTS street varchar,
             ADD COLUMN IF NOT EXISTS housenumber varchar,
@@ -142,66 +127,57 @@ class OverturePOICollection(OvertureBaseCollection):
 
         print_info(f"created table temporal.places_{self.region} including geometry index and pkey")
 
-        cur = self.db_local.conn.cursor()
-
-        for index, geom in enumerate(region_geoms, start=1):
-            start_time = time.time()
-
-            clip_poi_overture = f"""
-                INSERT INTO temporal.places_{self.region} (id, names, other_categories, categories, street, housenumber, zipcode, brand, updatetime, version, confidence, websites, socials, emails, phones, addresses, sources, geometry)
-                WITH region AS (
-                    SELECT ST_SetSRID(ST_GeomFromText(ST_AsText('{geom[0]}')), 4326) AS geom
-                ),
-                new_pois AS (
-                    SELECT DISTINCT ON (p.id) p.*
-                    FROM temporal.places_{self.region}_raw p
-                    JOIN region r ON ST_Intersects(p.geometry, r.geom)
-                )
-                SELECT
-                    np.id,
-                    TRIM(BOTH '"' FROM (np.names::jsonb->'common'->0->'value')::text) AS names,
-                    CASE
-                        WHEN (np.categories::jsonb->'alternate'->>0) IS NOT NULL OR (np.categories::jsonb->'alternate'->>1) IS NOT NULL THEN
-                            ARRAY_REMOVE(ARRAY_REMOVE(ARRAY[(np.categories::jsonb->'alternate'->>0)::varchar, (np.categories::jsonb->'alternate'->>1)::varchar], NULL), '')
-                        ELSE
-                            ARRAY[]::varchar[]
-                    END AS other_categories,
-                    TRIM(BOTH '"' FROM (np.categories::jsonb->>'main')) AS categories,
-                    TRIM(substring((np.addresses::jsonb->0->>'freeform')::varchar from '^(.*)(?=\s\d)')) AS street,
-                    TRIM(substring((np.addresses::jsonb->0->>'freeform')::varchar from '(\s\d.*)$')) AS housenumber,
-                    (np.addresses::jsonb->0->>'postcode')::varchar AS zipcode,
-                    np.brand::jsonb->'names'->'common'->0->>'value' AS brand,
-                    np.updatetime,
-                    np.version,
-                    np.confidence,
-                    np.websites,
-                    np.socials,
-                    np.emails,
-                    np.phones,
-                    np.addresses,
-                    np.sources,
-                    np.geometry
-                FROM new_pois np
-            """
-
-            try:
-                cur.execute(clip_poi_overture)
-                self.db_local.conn.commit()
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                self.db_local.conn.rollback()
-
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            print_info(f"Processing geom {index} out of {len(region_geoms)}. This iteration took {elapsed_time} seconds.")
-
-        cur.close()
+        # clip the raw places to all region geometries in a single set-based spatial join
+        clip_poi_overture = f"""
+            DROP TABLE IF EXISTS region_geoms;
+            CREATE TEMP TABLE region_geoms AS
+            SELECT ST_SetSRID(ST_GeomFromText(g), 4326) AS geom
+            FROM unnest(%s::text[]) AS t(g);
+            CREATE INDEX ON region_geoms USING GIST (geom);
+            INSERT INTO temporal.places_{self.region} (id, names, other_categories, categories, street, housenumber, zipcode, brand, updatetime, version, confidence, websites, socials, emails, phones, addresses, sources, geometry)
+            WITH new_pois AS (
+                SELECT DISTINCT ON (p.id) p.*
+                FROM temporal.places_{self.region}_raw p
+                JOIN region_geoms r ON ST_Intersects(p.geometry, r.geom)
+            )
+            SELECT
+                np.id,
+                np.names->'common'->0->>'value' AS names,
+                CASE
+                    WHEN (np.categories->'alternate'->>0) IS NOT NULL OR (np.categories->'alternate'->>1) IS NOT NULL THEN
+                        ARRAY_REMOVE(ARRAY_REMOVE(ARRAY[(np.categories->'alternate'->>0)::varchar, (np.categories->'alternate'->>1)::varchar], NULL), '')
+                    ELSE
+                        ARRAY[]::varchar[]
+                END AS other_categories,
+                np.categories->>'main' AS categories,
+                TRIM(addr.parts[1]) AS street,
+                TRIM(addr.parts[2]) AS housenumber,
+                (np.addresses->0->>'postcode')::varchar AS zipcode,
+                np.brand->'names'->'common'->0->>'value' AS brand,
+                np.updatetime,
+                np.version,
+                np.confidence,
+                np.websites,
+                np.socials,
+                np.emails,
+                np.phones,
+                np.addresses,
+                np.sources,
+                np.geometry
+            FROM new_pois np
+            CROSS JOIN LATERAL (
+                SELECT regexp_match(np.addresses->0->>'freeform', '^(.*)(\s\d.*)$') AS parts
+            ) addr;
+            DROP TABLE region_geoms;
+        """
+        self.db_local.perform(clip_poi_overture, ([geom[0] for geom in region_geoms],))
+        print_info(f"Clipped places to {len(region_geoms)} region geometries in a single spatial join.")
 
         # Convert unlogged table to regular table
         convert_to_regular_table_sql = f"""
             ALTER TABLE temporal.places_{self.region}_raw SET LOGGED;
             ALTER TABLE temporal.places_{self.region} ADD PRIMARY KEY (id);
-            CREATE INDEX ON temporal.places_{self.region} USING GIST (geometry);
+            CREATE INDEX ON temporal.places_{self.region} USING SPGIST (geometry);
         """
         self.db_local.perform(convert_to_regular_table_sql)
         print_info(f"Converted temporal.places_{self.region}_raw to a regular table")
@@ -18,69 +18,81 @@ class PublicTransportStopPreparation:
     def run(self):
         """Run the public transport stop preparation."""
 
-        # get the geometires of the study area based on the query defined in the config
-        region_geoms = self.db.select(self.data_config_preparation['region'])
+        # get the geometires of the study area as WKT based on the query defined in the config
+        region_geoms = self.db.select(
+            f"""SELECT ST_AsText(geom) FROM ({self.data_config_preparation['region']}) AS region"""
+        )
 
         print_info(f"Started to create table basic.poi_public_transport_stop_{self.region}.")
         # Create table for public transport stops
         self.db.perform(POITable(data_set_type="poi", schema_name="basic", data_set_name=f"public_transport_stop_{self.region}").create_poi_table(table_type='standard'))
         print_info(f"Created table basic.poi_public_transport_stop_{self.region}.")
 
-        # loops through the geometries of the study area and classifies the public transport stops based on GTFS
-        # loops through the gtfs stops and classifies them based on the route type in the stop_times table
-        for i, geom in enumerate(region_geoms):
-            ts = time.time()
-
-            classify_gtfs_stop_sql = f"""
-                INSERT INTO basic.poi_public_transport_stop_{self.region}(
-                    category,
-                    name,
-                    source,
-                    tags,
-                    geom
-                )
-                WITH parent_station_name AS (
-                    SELECT s.stop_name AS name, s.stop_id
-                    FROM basic.stops s
-                    WHERE ST_Intersects(s.geom, ST_SetSRID(ST_GeomFromText(ST_AsText('{geom[0]}')), 4326))
-                    AND parent_station IS NULL
-                ),
-                clipped_gfts_stops AS (
-                    SELECT p.name, s.geom, json_build_object('stop_id', s.stop_id, 'parent_station', s.parent_station, 'h3_3', s.h3_3) AS tags
-                    FROM basic.stops s, parent_station_name p
-                    WHERE ST_Intersects(s.geom, ST_SetSRID(ST_GeomFromText(ST_AsText('{geom[0]}')), 4326))
-                    AND parent_station IS NOT NULL
-                    AND s.parent_station = p.stop_id
-                ),
-                categorized_gtfs_stops AS (
-                    SELECT route_type, c.name, c.geom, c.tags
-                    FROM clipped_gfts_stops c
-                    CROSS JOIN LATERAL
-                    (
-                        SELECT  '{json.dumps(self.data_config_preparation['classification']['gtfs_route_types'])}'::jsonb ->> r.route_type::TEXT AS route_type
-                        FROM
-                        (
-                            SELECT DISTINCT o.route_type
-                            FROM basic.stop_times_optimized o
-                            WHERE o.stop_id = tags ->> 'stop_id'
-                            AND o.h3_3 = (c.tags ->> 'h3_3')::integer
-                            AND o.route_type IN {tuple(int(key) for key in self.data_config_preparation['classification']['gtfs_route_types'].keys())}
-                        ) r
-                        WHERE route_type IS NOT NULL
-                        ORDER BY r.route_type
-                    ) j
-                )
-                SELECT route_type AS category, name, NULL AS source, json_build_object('extended_source', json_build_object('stop_id', ARRAY_AGG(tags ->> 'stop_id')), 'parent_station', tags ->> 'parent_station') AS tags, ST_MULTI(ST_UNION(geom)) AS geom
-                FROM categorized_gtfs_stops
-                GROUP BY route_type, tags ->> 'parent_station', name
-                ;
-            """
-
-            self.db.perform(classify_gtfs_stop_sql)
-
-            te = time.time()  # End time of the iteration
-            iteration_time = te - ts  # Time taken by the iteration
-            print_info(f"Processing {i + 1} of {len(region_geoms)}. Iteration time: {iteration_time} seconds.")
+        # make sure the route type lookup against the stop times is backed by a covering index
+        create_stop_times_index_sql = """
+            CREATE INDEX IF NOT EXISTS stop_times_optimized_lookup
+            ON basic.stop_times_optimized (stop_id, h3_3, route_type);
+            ANALYZE basic.stop_times_optimized;
+        """
+        self.db.perform(create_stop_times_index_sql)
+
+        # the route type mapping and the accepted route types are constant across all statements
+        route_types_json = json.dumps(self.data_config_preparation['classification']['gtfs_route_types'])
+        gtfs_route_types = tuple(int(key) for key in self.data_config_preparation['classification']['gtfs_route_types'].keys())
+        region_geom_texts = [geom[0] for geom in region_geoms]
+
+        # classifies the gtfs stops with a parent station in a single set-based pass over all region geometries
+        ts = time.time()
+        classify_gtfs_stop_sql = f"""
+            INSERT INTO basic.poi_public_transport_stop_{self.region}(
+                category,
+                name,
+                source,
+                tags,
+                geom
+            )
+            WITH rt AS (
+                SELECT %s::jsonb AS map
+            ),
+            regions AS (
+                SELECT ST_SetSRID(ST_GeomFromText(g), 4326) AS geom
+                FROM unnest(%s::text[]) AS t(g)
+            ),
+            parent_station_name AS (
+                SELECT DISTINCT ON (s.stop_id) s.stop_name AS name, s.stop_id
+                FROM basic.stops s
+                JOIN regions r ON ST_Intersects(s.geom, r.geom)
+                WHERE parent_station IS NULL
+            ),
+            clipped_gfts_stops AS (
+                SELECT DISTINCT ON (s.stop_id) p.name, s.geom, json_build_object('stop_id', s.stop_id, 'parent_station', s.parent_station, 'h3_3', s.h3_3) AS tags
+                FROM basic.stops s
+                JOIN regions r ON ST_Intersects(s.geom, r.geom)
+                JOIN parent_station_name p ON s.parent_station = p.stop_id
+                WHERE s.parent_station IS NOT NULL
+            ),
+            routes_per_stop AS (
+                SELECT o.stop_id, o.h3_3, o.route_type
+                FROM basic.stop_times_optimized o
+                WHERE o.route_type IN {gtfs_route_types}
+                GROUP BY o.stop_id, o.h3_3, o.route_type
+            ),
+            categorized_gtfs_stops AS (
+                SELECT rt.map ->> r.route_type::TEXT AS route_type, c.name, c.geom, c.tags
+                FROM clipped_gfts_stops c
+                CROSS JOIN rt
+                JOIN routes_per_stop r
+                ON r.stop_id = c.tags ->> 'stop_id'
+                AND r.h3_3 = (c.tags ->> 'h3_3')::integer
+                WHERE rt.map ->> r.route_type::TEXT IS NOT NULL
+            )
+            SELECT route_type AS category, name, NULL AS source, json_build_object('extended_source', json_build_object('stop_id', ARRAY_AGG(tags ->> 'stop_id')), 'parent_station', tags ->> 'parent_station') AS tags, ST_MULTI(ST_UNION(geom)) AS geom
+            FROM categorized_gtfs_stops
+            GROUP BY route_type, tags ->> 'parent_station', name
+            ;
+        """
+        self.db.perform(classify_gtfs_stop_sql, (route_types_json, region_geom_texts))
+        print_info(f"Classified stops for {len(region_geoms)} region geometries in {time.time() - ts} seconds.")
 
         print_info("Stops with parent station have been classified")
         print_info("Creating temporal.remaining_stops")
@@ -92,68 +104,69 @@ class PublicTransportStopPreparation:
                 SELECT
                     unnest(string_to_array(ppts.tags ->> 'parent_station', ',')) AS stop_id
                 FROM basic.poi_public_transport_stop_{self.region} ppts
-                UNION
+                UNION ALL
                 SELECT
                     jsonb_array_elements_text(ppts.tags -> 'extended_source' -> 'stop_id') AS stop_id
                 FROM basic.poi_public_transport_stop_{self.region} ppts
             )
             SELECT s.*
             FROM basic.stops s
-            LEFT JOIN processed_staions ps
-            ON s.stop_id = ps.stop_id
-            WHERE ps.stop_id IS NULL;
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM processed_staions ps
+                WHERE ps.stop_id = s.stop_id
+            );
+            ANALYZE temporal.remaining_stations;
         """
         self.db.perform(remaining_stops_sql)
 
         print_info("temporal.remaining_stops has been created")
 
-        # loops through the remaining stops and group them by name
+        # classifies the remaining stops, grouped by name, in a single set-based pass as well
         print_info("Classifying remaining stops started.")
-        for i, geom in enumerate(region_geoms):
-            ts = time.time()
-
-            classify_gtfs_stop_sql = f"""
-                INSERT INTO basic.poi_public_transport_stop_{self.region}(
-                    category,
-                    name,
-                    source,
-                    tags,
-                    geom
-                )
-                WITH clipped_gfts_stops AS (
-                    SELECT s.stop_name, s.geom, json_build_object('stop_id', s.stop_id, 'h3_3', s.h3_3) AS tags
-                    FROM temporal.remaining_stations s
-                    WHERE ST_Intersects(s.geom, ST_SetSRID(ST_GeomFromText(ST_AsText('{geom[0]}')), 4326))
-                ),
-                categorized_gtfs_stops AS (
-                    SELECT route_type, c.stop_name, c.geom, c.tags
-                    FROM clipped_gfts_stops c
-                    CROSS JOIN LATERAL
-                    (
-                        SELECT  '{json.dumps(self.data_config_preparation['classification']['gtfs_route_types'])}'::jsonb ->> r.route_type::TEXT AS route_type
-                        FROM
-                        (
-                            SELECT DISTINCT o.route_type
-                            FROM basic.stop_times_optimized o
-                            WHERE o.stop_id = tags ->> 'stop_id'
-                            AND o.h3_3 = (c.tags ->> 'h3_3')::integer
-                            AND o.route_type IN {tuple(int(key) for key in self.data_config_preparation['classification']['gtfs_route_types'].keys())}
-                        ) r
-                        WHERE route_type IS NOT NULL
-                        ORDER BY r.route_type
-                    ) j
-                )
-                SELECT route_type AS category, stop_name AS name, NULL AS source, json_build_object('extended_source', json_build_object('stop_id', ARRAY_AGG(tags ->> 'stop_id'))) AS tags, ST_MULTI(ST_UNION(geom)) AS geom
-                FROM categorized_gtfs_stops
-                GROUP BY route_type, stop_name
-                ;
-            """
-
-            self.db.perform(classify_gtfs_stop_sql)
-
-            te = time.time()  # End time of the iteration
-            iteration_time = te - ts  # Time taken by the iteration
-            print_info(f"Processing {i + 1} of {len(region_geoms)}. Iteration time: {iteration_time} seconds.")
+        ts = time.time()
+        classify_remaining_stops_sql = f"""
+            INSERT INTO basic.poi_public_transport_stop_{self.region}(
+                category,
+                name,
+                source,
+                tags,
+                geom
+            )
+            WITH rt AS (
+                SELECT %s::jsonb AS map
+            ),
+            regions AS (
+                SELECT ST_SetSRID(ST_GeomFromText(g), 4326) AS geom
+                FROM unnest(%s::text[]) AS t(g)
+            ),
+            clipped_gfts_stops AS (
+                SELECT DISTINCT ON (s.stop_id) s.stop_name, s.geom, json_build_object('stop_id', s.stop_id, 'h3_3', s.h3_3) AS tags
+                FROM temporal.remaining_stations s
+                JOIN regions r ON ST_Intersects(s.geom, r.geom)
+            ),
+            routes_per_stop AS (
+                SELECT o.stop_id, o.h3_3, o.route_type
+                FROM basic.stop_times_optimized o
+                WHERE o.route_type IN {gtfs_route_types}
+                GROUP BY o.stop_id, o.h3_3, o.route_type
+            ),
+            categorized_gtfs_stops AS (
+                SELECT rt.map ->> r.route_type::TEXT AS route_type, c.stop_name, c.geom, c.tags
+                FROM clipped_gfts_stops c
+                CROSS JOIN rt
+                JOIN routes_per_stop r
+                ON r.stop_id = c.tags ->> 'stop_id'
+                AND r.h3_3 = (c.tags ->> 'h3_3')::integer
+                WHERE rt.map ->> r.route_type::TEXT IS NOT NULL
+            )
+            SELECT route_type AS category, stop_name AS name, NULL AS source, json_build_object('extended_source', json_build_object('stop_id', ARRAY_AGG(tags ->> 'stop_id'))) AS tags, ST_MULTI(ST_UNION(geom)) AS geom
+            FROM categorized_gtfs_stops
+            GROUP BY route_type, stop_name
+            ;
+        """
+        self.db.perform(classify_remaining_stops_sql, (route_types_json, region_geom_texts))
+        print_info(f"Classified remaining stops for {len(region_geoms)} region geometries in {time.time() - ts} seconds.")
 
 def prepare_public_transport_stop(region: str):
 